@@ -1,6 +1,13 @@
+import asyncio
+import collections
 import discord
 import os
 import random
+import secrets
+import socket
+import time
+import aiohttp
+from discord import app_commands
 from discord.ext import commands
 from dotenv import load_dotenv
 from aiohttp import web
@@ -8,24 +15,166 @@ from aiohttp import web
 # gotta load that token from .env file
 load_dotenv()
 TOKEN = os.getenv("DISCORD_TOKEN")
+SYNC_COMMANDS = os.getenv("SYNC_COMMANDS") == "1"  # push slash commands to discord on startup
 
-# need this or discord won't let us read messages
+# commands come in as slash commands (interactions) now, so we don't need the
+# message_content intent and discord doesn't have to send us every message
+# (catch: without it the typed "/game 100" prefix form only works in DMs, not in servers)
 intents = discord.Intents.default()
-intents.message_content = True
 bot = commands.Bot(command_prefix="/", intents=intents)
 
-# dict to track all active games per user
-active_games = {}
+# one shared http session for any outbound calls so connections get reused
+# (gets made in on_ready, since it needs the event loop running)
+bot.http_session = None
+
+# keeps track of everyone's games, plus who is "holding" a user's game right now
+# so the same person can't run two commands on it at once
+# (every read and write goes through a method that checks the holder's token)
+class TaintableGameStore:
+    def __init__(self):
+        # one dict per field instead of a dict per game
+        self.secrets = {}   # user id -> secret number
+        self.attempts = {}  # user id -> attempts left
+        self.owners = {}    # user id -> token of whoever is using the game
+
+    def try_acquire(self, uid):
+        # setdefault is atomic so no lock needed, first one in wins
+        token = object()
+        if self.owners.setdefault(uid, token) is token:
+            return token
+        return None  # someone else already has it
+
+    def release(self, uid, token):
+        if self.owners.get(uid) is token:
+            del self.owners[uid]
+
+    def read(self, uid, token):
+        # only whoever holds the token gets to see the secret
+        if self.owners.get(uid) is not token:
+            return None
+        return self.secrets.get(uid)
+
+    def start(self, uid, token, secret, attempts):
+        # same deal for setting up a new game
+        if self.owners.get(uid) is not token:
+            return False
+        self.secrets[uid] = secret
+        self.attempts[uid] = attempts
+        return True
+
+    def use_attempt(self, uid, token):
+        # takes one attempt off and gives back how many are left (None if it's not theirs)
+        if self.owners.get(uid) is not token or uid not in self.attempts:
+            return None
+        self.attempts[uid] -= 1
+        return self.attempts[uid]
+
+    def remove(self, uid, token):
+        if self.owners.get(uid) is not token:
+            return
+        self.secrets.pop(uid, None)
+        self.attempts.pop(uid, None)
+
+games = TaintableGameStore()
+
+# every wrong-guess hint built once up front, attempts left is always 1-9
+# index with (attempts_left - 1) * 2 + (1 if the answer is higher else 0)
+HINT_MSGS = tuple(
+    f"Incorrect guess! You have {a} attempts left! Try again. The correct number is {'higher' if h else 'lower'}."
+    for a in range(1, 10)
+    for h in (0, 1)
+)
+
+# code block wrapping for /code, made once instead of rebuilt for every chunk
+CODE_PREFIX = "```jsx\n"
+CODE_SUFFIX = "\n```"
+
+SEND_RETRIES = 4  # how many times to try a message before giving up
+
+# last message per user per channel so we don't post the exact same thing to them twice in a row
+DEDUPE_WINDOW = 2.0  # seconds
+# oldest send first, so expired ones can be dropped off the front and it doesn't grow forever
+recent_messages = collections.OrderedDict()  # (channel id, user id) -> (hash of last message, time we sent it)
+
+# ctx.send but it waits and tries again if discord rate limits us (429)
+# discord.py already retries 429s on its own (up to 5 times) before raising,
+# so this only kicks in once those are used up
+# backoff is 2^attempt * retry-after plus a bit of jitter
+# pass dedupe=False for stuff that's allowed to repeat (like code chunks)
+async def safe_send(ctx, *args, dedupe=True, **kwargs):
+    key = None
+    # a slash command that hasn't been answered yet always gets its reply,
+    # otherwise discord shows them "The application did not respond"
+    interaction = ctx.interaction
+    if dedupe and args and (interaction is None or interaction.response.is_done()):
+        key = (ctx.channel.id, ctx.author.id)
+        fingerprint = hash(args[0])
+        last = recent_messages.get(key)
+        if last is not None and last[0] == fingerprint and time.monotonic() - last[1] < DEDUPE_WINDOW:
+            return None  # same message to the same person a moment ago, skip it
+
+    send = ctx.send  # look it up once, not on every retry
+    for attempt in range(SEND_RETRIES):
+        try:
+            message = await send(*args, **kwargs)
+        except discord.HTTPException as e:
+            if e.status != 429 or attempt == SEND_RETRIES - 1:
+                raise
+            retry_after = float(e.response.headers.get("Retry-After", 1))
+            await asyncio.sleep((2 ** attempt) * retry_after + random.random() * 0.1)
+            # the failed upload already read any files to the end, rewind them
+            # or the retry sends an empty file
+            files = list(kwargs.get("files") or ())
+            if kwargs.get("file") is not None:
+                files.append(kwargs["file"])
+            for f in files:
+                f.reset()
+            continue
+
+        # only remember it once it actually went out, a failed send shouldn't block the retry
+        if key is not None:
+            now = time.monotonic()
+            recent_messages[key] = (fingerprint, now)
+            recent_messages.move_to_end(key)
+            # anything older than the window can't match anymore, this one's always fresh so the loop stops
+            while now - next(iter(recent_messages.values()))[1] >= DEDUPE_WINDOW:
+                recent_messages.popitem(last=False)
+        return message
 
 # render keeps pinging this or our bot dies lol
 async def health_check(request):
-    return web.Response(text="OK")
+    # keep-alive so render's pinger can reuse the same connection
+    return web.Response(text="OK", headers={"Connection": "keep-alive"})
 
 def setup_web_server():
     app = web.Application()
     app.router.add_get('/health', health_check)
     return app
 
+# setup health check stuff for render hosting
+async def start_web_server():
+    app = setup_web_server()
+    runner = web.AppRunner(app)
+    await runner.setup()
+    port = int(os.environ.get('PORT', 10000))  # default to 10k if not set
+    # bigger backlog + reuse_port so restarts don't get connection refused (windows has no reuse_port)
+    site = web.TCPSite(runner, host='0.0.0.0', port=port, backlog=1024, reuse_port=hasattr(socket, "SO_REUSEPORT"))
+    await site.start()
+    print("Web server started for Render health checks")
+
+# register the slash commands with discord
+# only needed when commands change, so it's not done every start (we redeploy a lot)
+# set SYNC_COMMANDS=1 for one deploy, or DM the bot "/sync" as the owner
+async def sync_slash_commands():
+    try:
+        synced = await bot.tree.sync()
+    except discord.HTTPException as e:
+        # missing applications.commands scope, rate limited, etc, bot still works without it
+        print(f"Couldn't sync slash commands: {e}")
+        return None
+    print(f"Synced {len(synced)} slash commands")
+    return synced
+
 has_started = False  # prevents on_ready from running twice
 
 @bot.event
@@ -38,124 +187,228 @@ async def on_ready():
     print(f'Logged in as {bot.user} (ID: {bot.user.id})')
     print('------')
 
-    # setup health check stuff for render hosting
-    app = setup_web_server()
-    runner = web.AppRunner(app)
-    await runner.setup()
-    port = int(os.environ.get('PORT', 10000))  # default to 10k if not set
-    site = web.TCPSite(runner, host='0.0.0.0', port=port)
-    await site.start()
-    print("Web server started for Render health checks")
+    # keep-alive pool so we don't redo the tcp/tls handshake every request
+    # (made first since it's not async and the other startup stuff might want it)
+    connector = aiohttp.TCPConnector(limit=100, limit_per_host=30, keepalive_timeout=120, ttl_dns_cache=300)
+    bot.http_session = aiohttp.ClientSession(
+        connector=connector,
+        headers={"User-Agent": "ChronoChunk (https://github.com/Mykal-Steele/ChronoChunk)"},
+    )
 
+    # health server goes up first and on its own, render kills us if it's not there
+    await start_web_server()
 
-@bot.command(name="game")
-async def start_guess(ctx, max_range: int):
-    # check if they're already in a game
-    if ctx.author.id in active_games:
-        await ctx.send("You already have an active game! Finish it before starting a new one. Use `/end` to end the current game.")
+    # optional startup stuff runs at the same time instead of waiting on each one
+    # (add new stuff here as another task, and have it catch + print its own errors
+    # so one failing doesn't cancel the rest)
+    async with asyncio.TaskGroup() as tg:
+        if SYNC_COMMANDS:
+            tg.create_task(sync_slash_commands())
+
+@bot.event
+async def on_command_error(ctx, error):
+    # tell spammers when they can go again instead of just ignoring them
+    if isinstance(error, commands.CommandOnCooldown):
+        await safe_send(ctx, f"Slow down! Try again in {error.retry_after:.1f}s.")
         return
+    # failed checks (like someone who isn't the owner DMing "/sync") just get told no,
+    # no point printing a traceback for that. cooldowns are checks too so they go first
+    if isinstance(error, commands.CheckFailure):
+        await safe_send(ctx, "You can't use that command.")
+        return
+    # everything else goes to the normal handler (prints the traceback)
+    await commands.Bot.on_command_error(bot, ctx, error)
+
+# owner only, DM the bot "/sync" after changing the slash commands
+@bot.command(name="sync")
+@commands.is_owner()
+async def sync_commands(ctx):
+    synced = await sync_slash_commands()
+    if synced is None:
+        await safe_send(ctx, "Couldn't sync slash commands, check the logs.")
+    else:
+        await safe_send(ctx, f"Synced {len(synced)} slash commands.")
+
+
+@bot.hybrid_command(name="game")
+@app_commands.describe(max_range="Biggest number I can pick (starts at 1)")
+async def start_guess(ctx, max_range: int):
+    uid = ctx.author.id
 
     # make sure input isn't stupid
     if max_range < 1:
-        await ctx.send("Please provide a positive number greater than 1.")
+        await safe_send(ctx, "Please provide a positive number greater than 1.")
         return
 
-    # generate random number and set up game
-    secret = random.randint(1, max_range)
-    active_games[ctx.author.id] = {
-        "secret_number": secret,
-        "attempts_left": 10  # might make difficulty levels later
-    }
-    await ctx.send(f"Game Started! I'm thinking of a number between 1 and {max_range}. Start guessing with `/guess <your number>`. You have 10 attempts.")
+    # don't start a game while one of their guesses is still going
+    token = games.try_acquire(uid)
+    if token is None:
+        await safe_send(ctx, "Slow down! I'm still working on your last command.")
+        return
+
+    try:
+        # check if they're already in a game
+        if games.read(uid, token) is not None:
+            await safe_send(ctx, "You already have an active game! Finish it before starting a new one. Use `/end` to end the current game.")
+            return
+
+        # generate random number and set up game
+        # secrets can't be predicted like random's seed, and randbelow has no bias for any range
+        secret = 1 + secrets.randbelow(max_range)
+        games.start(uid, token, secret, 10)  # might make difficulty levels later
+        await safe_send(ctx, f"Game Started! I'm thinking of a number between 1 and {max_range}. Start guessing with `/guess <your number>`. You have 10 attempts.")
+    finally:
+        games.release(uid, token)
 
 # let people quit early if they want
-@bot.command(name="end")
+@bot.hybrid_command(name="end")
 async def end_game(ctx):
-    if ctx.author.id in active_games:
-        await ctx.send("Thank you for playing. Your current game has been ended.")
-        del active_games[ctx.author.id]
-    else:
-        await ctx.send("You don't have an active game to end.")
+    uid = ctx.author.id
+
+    # don't end a game while one of their guesses is still going
+    token = games.try_acquire(uid)
+    if token is None:
+        await safe_send(ctx, "Slow down! I'm still working on your last command.")
+        return
 
-@bot.command(name="guess")
+    try:
+        if games.read(uid, token) is not None:
+            await safe_send(ctx, "Thank you for playing. Your current game has been ended.")
+            games.remove(uid, token)
+        else:
+            await safe_send(ctx, "You don't have an active game to end.")
+    finally:
+        games.release(uid, token)
+
+@bot.hybrid_command(name="guess")
+@app_commands.rename(inp="number")
+@app_commands.describe(inp="Your guess")
+@commands.cooldown(3, 2.0, commands.BucketType.user)  # 3 guesses every 2s
 async def guess(ctx, inp: int):
-    # can't guess if not playing
-    if ctx.author.id not in active_games:
-        await ctx.send("You don't have an active game. Start one with `/game <max_range>`.") 
+    uid = ctx.author.id
+
+    # spamming guesses just gets bounced instead of piling up
+    token = games.try_acquire(uid)
+    if token is None:
+        await safe_send(ctx, "Slow down! I'm still working on your last guess.")
         return
 
-    # get their game info
-    game_data = active_games[ctx.author.id]
-    secret_number = game_data["secret_number"]
-    attempts_left = game_data["attempts_left"]
+    try:
+        # get their game info (None means they're not playing)
+        secret_number = games.read(uid, token)
 
-    # they got it!
-    if inp == secret_number:
-        await ctx.send(f"Your guess is correct!!! The correct answer is {secret_number}.")
-        del active_games[ctx.author.id]
-    else:
-        # wrong guess, decrease attempts
-        attempts_left -= 1
-        active_games[ctx.author.id]["attempts_left"] = attempts_left
-
-        if attempts_left > 0:
-            # give a hint so they don't get stuck
-            response = f"Incorrect guess! You have {attempts_left} attempts left! Try again."
-            if secret_number > inp:
-                response += " The correct number is higher."
-            else:
-                response += " The correct number is lower."
-            await ctx.send(response)
+        # can't guess if not playing
+        if secret_number is None:
+            await safe_send(ctx, "You don't have an active game. Start one with `/game <max_range>`.")
+            return
+
+        # they got it!
+        if inp == secret_number:
+            await safe_send(ctx, f"Your guess is correct!!! The correct answer is {secret_number}.")
+            games.remove(uid, token)
         else:
-            # ran out of tries oof
-            await ctx.send(f"GAME OVER! The correct number was {secret_number}. PLAY ANOTHER GAME!")
-            del active_games[ctx.author.id]
+            # wrong guess, decrease attempts
+            attempts_left = games.use_attempt(uid, token)
+
+            if attempts_left > 0:
+                # give a hint so they don't get stuck
+                await safe_send(ctx, HINT_MSGS[(attempts_left - 1) * 2 + (secret_number > inp)])
+            else:
+                # ran out of tries oof
+                await safe_send(ctx, f"GAME OVER! The correct number was {secret_number}. PLAY ANOTHER GAME!")
+                games.remove(uid, token)
+    finally:
+        games.release(uid, token)
 
 # splits code so it fits in discord messages
-@bot.command(name="code")
-async def code(ctx):
-    if not ctx.message.attachments:
-        await ctx.send("Please attach a `.txt` file. Only React (.jsx) code is supported for now.")
+@bot.hybrid_command(name="code")
+@app_commands.describe(attachment="The .txt file with your code")
+@commands.cooldown(1, 30.0, commands.BucketType.user)  # uploads files so keep it chill
+async def code(ctx, attachment: discord.Attachment = None):
+    if attachment is None:
+        ctx.command.reset_cooldown(ctx)  # nothing got uploaded, don't lock them out
+        await safe_send(ctx, "Please attach a `.txt` file. Only React (.jsx) code is supported for now.")
         return
-    
-    attachment = ctx.message.attachments[0]
+
+    # reading + splitting can take longer than the 3s discord gives us to reply
+    await ctx.defer()
 
     if not attachment.filename.endswith(".txt"):
-        await ctx.send("Only `.txt` files are supported.")
+        ctx.command.reset_cooldown(ctx)  # wrong file, let them try again right away
+        await safe_send(ctx, "Only `.txt` files are supported.")
         return
 
     try:
-        # grab the file content
+        # grab the file content (stays as bytes, we only decode the pieces we send)
         content = await attachment.read()
-        text = content.decode("utf-8")
 
         # discord has char limit so gotta split
+        # (limit is counted in bytes here, utf-8 never has fewer bytes than chars so it still fits)
         MAX_MSG_SIZE = 1900
         chunks = []
 
         # break at newlines to keep code readable
-        while len(text) > MAX_MSG_SIZE:
-            split_idx = text.rfind("\n", 0, MAX_MSG_SIZE)
-            if split_idx == -1:  # no good place to split found
-                break  
+        # (walk a start index forward instead of re-slicing the rest of the text each time,
+        # and search the raw bytes, a \n byte can't show up inside a multi-byte utf-8 char)
+        start = 0
+        after_cut = False  # did the last piece end with a hard cut instead of a newline
+        while len(content) - start > MAX_MSG_SIZE:
+            split_idx = content.rfind(b"\n", start, start + MAX_MSG_SIZE)
+            if split_idx == -1:
+                # no newline to break at (minified code etc) so just hard cut it,
+                # backing up a bit so we don't land in the middle of a utf-8 char
+                end = start + MAX_MSG_SIZE
+                while end > start + 1 and content[end] & 0xC0 == 0x80:
+                    end -= 1
+                next_start = end  # no newline to skip over this time
+                hard_cut = True
+            else:
+                end = split_idx
+                next_start = split_idx + 1
+                hard_cut = False
 
-            chunks.append(text[:split_idx].strip())
-            text = text[split_idx + 1:]
+            # only trim next to newlines, spaces at a hard cut are real code (like "var a = 1;")
+            piece = content[start:end].decode("utf-8")
+            if not after_cut:
+                piece = piece.lstrip()
+            if not hard_cut:
+                piece = piece.rstrip()
+
+            # skip empty bits (like when a hard cut lands right before a newline)
+            if piece.strip():
+                chunks.append(piece)
+            start = next_start
+            after_cut = hard_cut
 
         # add whatever's left
-        if text.strip():  
-            chunks.append(text.strip())
-        
+        rest = content[start:].decode("utf-8").rstrip()
+        if not after_cut:
+            rest = rest.lstrip()
+        if rest.strip():
+            chunks.append(rest)
+
         # send each part with code formatting
+        # (one at a time on purpose, sending them all at once can mix up the order)
         for chunk in chunks:
-            await ctx.send(f"```jsx\n{chunk}\n```")
+            await safe_send(ctx, CODE_PREFIX + chunk + CODE_SUFFIX, dedupe=False)
+
+    # only stuff that can actually go wrong here, real bugs should still show a traceback
+    except (UnicodeDecodeError, discord.HTTPException, aiohttp.ClientError, OSError) as e:
+        await safe_send(ctx, f"ERROR PROCESSING: {e}")
 
-    except Exception as e:
-        await ctx.send(f"ERROR PROCESSING: {e}")  
+    await safe_send(ctx, "Here is your entire code file split into messages for easy reading.")
+    await safe_send(ctx, "If you prefer, you can download the original `.txt` file here:", file=await attachment.to_file(), dedupe=False)
 
-    await ctx.send("Here is your entire code file split into messages for easy reading.")
-    await ctx.send("If you prefer, you can download the original `.txt` file here:", file=await attachment.to_file())
+async def main():
+    async with bot:
+        try:
+            await bot.start(TOKEN)
+        finally:
+            # close the shared session so aiohttp doesn't yell about it on exit
+            if bot.http_session is not None:
+                await bot.http_session.close()
 
 # start the bot
 if __name__ == "__main__":
-    bot.run(TOKEN)
\ No newline at end of file
+    discord.utils.setup_logging()  # bot.run used to do this for us
+    asyncio.run(main())
\ No newline at end of file